@@ -4,18 +4,22 @@ A very simple script that takes two png images that form a recto/version PDF doc
 The script creates a PDF file that can be used for a mailing.
 """
 
-import csv
+import csv, itertools, os, struct
 try:
     from fpdf import FPDF
-    import sys, fitz
+    from fpdf.image_parsing import preload_image
+    from fpdf.image_datastructures import RasterImageInfo
 except ImportError:
-    print("ERROR: You must install fpdf with 'pip install fpdf' and pymupdf with 'pip install pymupdf' ")
+    print("ERROR: You must install fpdf2 with 'pip install fpdf2'")
     exit(0)
 
 __author__ = "Jean Laroche"
 __version__ = 1.0
 __license__ = "GPL"
 
+# Translation table used to remove quotes and = signs from the csv fields.
+_STRIP = str.maketrans('', '', '"=')
+
 class PDF(FPDF):
     def __init__(self,recto,verso,numPerPage=1,margin=0,xAdjust=0,yAdjust=0,fontSizeAdjust=0):
         """
@@ -37,6 +41,7 @@ class PDF(FPDF):
         self.verso = verso
         self.numPerPage = numPerPage
         self.defFontSize = 15
+        self.computeGeometry()
 
     def setAddressList(self,csvFile,headerLines=1,sortByZip=0):
         """
@@ -45,41 +50,114 @@ class PDF(FPDF):
         :param headerLines:     number of header lines to skip in csv file.
         """
         self.sortByZip = sortByZip
-        with open(csvFile, newline='') as csvfile:
+        # Use a large read buffer, address lists can be several MB long.
+        with open(csvFile, newline='', buffering=1<<20) as csvfile:
             addresses = csv.reader(csvfile, dialect='unix')
-            allRows = []
-            for ii,row in enumerate(addresses):
-                if ii < headerLines: continue
-                # Remove quotes and remove = sign.
-                row = [r.replace('"','').replace("=","") for r in row]
-                allRows.append(row)
+            # Skip the header lines (none if headerLines is negative)
+            headerLines = max(headerLines, 0)
+            next(itertools.islice(addresses, headerLines, headerLines), None)
+            # Remove quotes and remove = sign.
+            allRows = [[r.translate(_STRIP) for r in row] for row in addresses]
 
             # Now, sort the rows by zip code
             if self.sortByZip:
                 allRows = sorted(allRows,key=lambda x: x[-1])
 
             # Create the address strings
-            self.addresses = []
-            for row in allRows:
+            self.addresses = [None] * len(allRows)
+            for ii,row in enumerate(allRows):
                 city = " ".join(row[-3:])
-                self.addresses.append("\n".join(row[0:-3]+[city]))
+                self.addresses[ii] = "\n".join(itertools.chain(row[:-3], (city,)))
+
+    def computeGeometry(self):
+        """
+        Computes the size of the images and the position of the addresses, which are the same on every page.
+        """
+        m = self.margin
+        # Sizes for the images.
+        self._wImg = self.w-2*m
+        self._hImg = self.h-2*m
+        # Position of the address (of the first address if 2 prints per page)
+        self._xAddress = .6*self.w + self.xAdjust
+        if self.numPerPage == 1:
+            self._yAddress1 = self.h * .55 + self.yAdjust
+        else:
+            self._yAddress1 = self.h * .3 + self.yAdjust
+        # Position of the second address
+        self._yAddress2 = self._yAddress1 + self.h/2
+        # Width of the address box.
+        self._wAddress = self.w-m - .5 - self._xAddress
+
+    def loadRawPNG(self,file):
+        """
+        Adds a png file to the image cache by copying its compressed data as is, instead of letting fpdf decode and
+        re-compress it. Only 8 bit, non-interlaced grayscale or RGB images without color profile can be copied.
+        :param file:    path to the image file
+        :return:        True if the image was added to the cache, False if it must be loaded by fpdf.
+        """
+        if not file.lower().endswith('.png'):
+            return False
+        with open(file, 'rb') as f:
+            data = f.read()
+        if data[:8] != b'\x89PNG\r\n\x1a\n':
+            return False
+        pos = 8
+        idat = []
+        while pos < len(data):
+            length, chunk = struct.unpack('>I4s', data[pos:pos+8])
+            body = data[pos+8:pos+8+length]
+            pos += 12+length
+            if chunk == b'IHDR':
+                w, h, bitDepth, colorType, _, _, interlace = struct.unpack('>IIBBBBB', body)
+                if bitDepth != 8 or colorType not in (0, 2) or interlace:
+                    return False
+            elif chunk == b'IDAT':
+                idat.append(body)
+            elif chunk in (b'iCCP', b'tRNS'):
+                return False
+            elif chunk == b'IEND':
+                break
+        # The IDAT data is a zlib stream of rows each starting with a png filter byte, which is exactly what
+        # FlateDecode with the png predictors expects.
+        dpn = 1 if colorType == 0 else 3
+        self.image_cache.images[file] = RasterImageInfo(
+            data=b''.join(idat), w=w, h=h, cs='DeviceGray' if colorType == 0 else 'DeviceRGB', iccp=None,
+            iccp_i=None, bpc=8, dpn=dpn, f='FlateDecode', inverted=False, dp=f"/Predictor 15 /Colors {dpn} /Columns {w}",
+            i=len(self.image_cache.images)+1, usages=1)
+        return True
 
     def addTwoPages(self,onlyVerso=0):
         """
         Adds two pages to the pdf file, one for the recto, one for the verso
         :param onlyVerso:   if 1, only add the verso page.
         """
+        m, w, h = self.margin, self._wImg, self._hImg
         if not onlyVerso:
             self.add_page()
-            # Sizes for the images.
-            w = self.w-2*self.margin
-            h = (self.h-2*self.margin)
-            self.image(self.recto, x=self.margin, y=self.margin, w=w, h=h)
+            self.image(self.recto, x=m, y=m, w=w, h=h)
         self.add_page()
-        # Sizes for the images.
-        w = self.w-2*self.margin
-        h = (self.h-2*self.margin)
-        self.image(self.verso, x=self.margin, y=self.margin, w=w, h=h)
+        self.image(self.verso, x=m, y=m, w=w, h=h)
+
+    def writeAddress(self,x,y,h,address):
+        """
+        Writes an address in the address box. Lines that fit in the box are written with one cell each, which is much
+        cheaper than multi_cell. If a line is too long, multi_cell is used to wrap it.
+        :param x:       horizontal position of the address
+        :param y:       vertical position of the address
+        :param h:       line height
+        :param address: string to be used for the address
+        """
+        w = self._wAddress
+        lines = address.split('\n')
+        maxWidth = w - 2*self.c_margin
+        if any(self.get_string_width(line) > maxWidth for line in lines):
+            self.set_xy(x = x, y = y)
+            self.multi_cell(w = w, h = h, text= address, border = 0, align= 'L', fill= False)
+            return
+        for line in lines:
+            self.set_xy(x = x, y = y)
+            self.cell(w = w, h = h, text= line, border = 0, align= 'L', fill= False)
+            y += h
 
     def newPageOne(self,address,onlyVerso=0):
         """
@@ -88,14 +166,7 @@ class PDF(FPDF):
         :param onlyVerso: if 1 only output verso
         """
         self.addTwoPages(onlyVerso)
-        # Position of the address
-        xAddress = .6*self.w + self.xAdjust
-        yAddress =  self.h * .55 + self.yAdjust
-        # Width of the address box.
-        w = self.w-self.margin - .5 - xAddress
-
-        self.set_xy(x = xAddress, y = yAddress)
-        self.multi_cell(w = w, h = .25, txt= address, border = 0, align= 'L', fill= False)
+        self.writeAddress(self._xAddress, self._yAddress1, .25, address)
 
     def newPageTwo(self,address1,address2,onlyVerso=0):
         """
@@ -105,71 +176,130 @@ class PDF(FPDF):
         :param onlyVerso: if 1 only output verso
         """
         self.addTwoPages(onlyVerso)
-        # Position of the first address
-        xAddress = .6*self.w + self.xAdjust
-        yAddress =  self.h * .3 +  self.yAdjust
-        # Width of the address box.
-        w = self.w-self.margin - .5 - xAddress
+        self.writeAddress(self._xAddress, self._yAddress1, .2, address1)
+        self.writeAddress(self._xAddress, self._yAddress2, .2, address2)
 
-        self.set_xy(x = xAddress, y = yAddress)
-        self.multi_cell(w = w, h = .2, txt= address1, border = 0, align= 'L', fill= False)
+    def addPages(self,addresses,testMode=0):
+        """
+        Adds the pages for a list of addresses to the PDF.
+        :param addresses:   list of addresses, or of (address1,address2) pairs for 2 prints per page
+        :param testMode:    If 1, only output verso pages
+        """
+        self.set_font('Times', '', self.defFontSize+self.fontSizeAdjust if self.numPerPage == 1 else self.defFontSize-2+self.fontSizeAdjust)
+        self.set_margins(left=self.margin, top=self.margin, right=self.margin)
+        self.computeGeometry()
+        # Decode the images once: every page then refers to the same cached image object in the pdf.
+        for image in ([self.verso] if testMode else [self.recto, self.verso]):
+            if image not in self.image_cache.images and not self.loadRawPNG(image):
+                preload_image(self.image_cache, image)
 
-        # Position of the second address
-        yAddress += self.h/2
-        self.set_xy(x = xAddress, y = yAddress)
-        self.multi_cell(w = w, h = .2, txt= address2, border = 0, align= 'L', fill= False)
+        if self.numPerPage == 1:
+            for address in addresses:
+                self.newPageOne(address,testMode)
+        else:
+            for address1,address2 in addresses:
+                self.newPageTwo(address1,address2,testMode)
 
-    def createPDF(self,outFile,numPages=1000,testMode=0):
+    def createPDF(self,outFile,numPages=1000,testMode=0,numJobs=1):
         """
         Create the PDF document
         :param outFile:     Name of output pdf file
         :param numPages:    Maximum number of pages to create
         :param testMode:    If 1, sort pages by length of output address
+        :param numJobs:     Number of processes used to render the pages (0 to use all cores)
         """
-        self.set_font('Times', '', self.defFontSize+self.fontSizeAdjust if self.numPerPage == 1 else self.defFontSize-2+self.fontSizeAdjust)
-        self.set_margins(left=self.margin, top=self.margin, right=self.margin)
-
         addresses = self.addresses
         if testMode:
             # Sort addresses by decreasing address length
-            addresses = sorted(addresses, key=lambda x: -max([len(y) for y in x.split('\n')]))
+            addresses = sorted(addresses, key=lambda x: max(map(len, x.split('\n'))), reverse=True)
         if self.numPerPage == 2:
-            # Add an extra empty address if we don't have an even number
-            if len(addresses) % 2: addresses.append("")
-            L = len(addresses)//2
+            # If we don't have an even number of addresses, the last one is paired with an empty address
+            L = (len(addresses)+1)//2
             if self.sortByZip and not testMode:
                 # This is so when the pages are physically cut in half, the top halves are in consecutive zip order, followed by
                 # the bottom halves
-                addresses = list(zip(addresses[0:L], addresses[L:]))
+                pairs = itertools.zip_longest(itertools.islice(addresses, L), itertools.islice(addresses, L, None), fillvalue="")
             else:
-                addresses = list(zip(addresses[0:2 * L:2], addresses[1:2 * L:2]))
-
-        _numPages = min(numPages, len(addresses))
-        if self.numPerPage == 1:
-            for address in addresses[0:numPages]:
-                self.newPageOne(address,testMode)
+                # Pair consecutive addresses, without copying the list
+                it = iter(addresses)
+                pairs = itertools.zip_longest(it, it, fillvalue="")
+            addresses = list(itertools.islice(pairs, numPages))
         else:
-            for address1,address2 in addresses[0:numPages]:
-                self.newPageTwo(address1,address2,testMode)
+            addresses = addresses[0:numPages]
+
+        numJobs = numJobs or os.cpu_count()
+        if numJobs > 1 and len(addresses) > 1:
+            self.createPDFParallel(outFile,addresses,testMode,numJobs)
+            return
+
+        self.addPages(addresses,testMode)
         print("Saving output ...")
-        self.output(outFile, 'F')
+        self.output(outFile)
         print(f"Output pdf written to {outFile}")
 
+    def createPDFParallel(self,outFile,addresses,testMode,numJobs):
+        """
+        Create the PDF document by rendering chunks of addresses in separate processes, then concatenating the chunks.
+        :param outFile:     Name of output pdf file
+        :param addresses:   list of addresses, or of (address1,address2) pairs for 2 prints per page
+        :param testMode:    If 1, only output verso pages
+        :param numJobs:     Number of processes
+        """
+        import multiprocessing, tempfile
+        try:
+            from pypdf import PdfWriter
+        except ImportError:
+            raise Exception("You must install pypdf with 'pip install pypdf' to render pages in parallel")
+        numJobs = min(numJobs, len(addresses))
+        chunkSize = -(-len(addresses) // numJobs)
+        pdfArgs = (self.recto,self.verso,self.numPerPage,self.margin,self.xAdjust,self.yAdjust,self.fontSizeAdjust)
+        with tempfile.TemporaryDirectory() as tmpDir:
+            jobs = [(pdfArgs, addresses[ii:ii+chunkSize], testMode, os.path.join(tmpDir, f"chunk{ii}.pdf"))
+                    for ii in range(0, len(addresses), chunkSize)]
+            print(f"Rendering pages with {len(jobs)} processes ...")
+            with multiprocessing.Pool(len(jobs)) as pool:
+                chunkFiles = pool.map(_renderChunk, jobs)
+            print("Saving output ...")
+            writer = PdfWriter()
+            for chunkFile in chunkFiles:
+                writer.append(chunkFile)
+            # Each chunk embeds its own copy of the recto and verso images, only keep one.
+            writer.compress_identical_objects()
+            writer.write(outFile)
+        print(f"Output pdf written to {outFile}")
+
+def _renderChunk(job):
+    """
+    Render a chunk of addresses to a pdf file. Used by PDF.createPDFParallel in the worker processes.
+    :param job: tuple (PDF constructor arguments, addresses, testMode, output file)
+    :return: the output file
+    """
+    pdfArgs, addresses, testMode, outFile = job
+    pdf = PDF(*pdfArgs)
+    pdf.addPages(addresses,testMode)
+    pdf.output(outFile)
+    return outFile
+
 def extractImgsFromPDF(file):
     """
     Extract Recto and Verso from pdf file as images.
     :param file: input pdf file.
     """
+    # pymupdf is slow to import and only needed here.
+    try:
+        import fitz
+    except ImportError:
+        raise Exception("You must install pymupdf with 'pip install pymupdf' to use the -i option")
     print(f"Extracting recto and verso from {file}")
     doc = fitz.open(file)
     if doc.page_count < 2:
         raise Exception("Input PDF document must have at least two pages, one for recto, one for verso")
-    page = doc[0]
-    pix = page.get_pixmap(dpi=600)
-    pix.save("recto_.png")
-    page = doc[1]
-    pix = page.get_pixmap(dpi=600)
-    pix.save("verso_.png")
+    # 300 dpi is plenty for printing, and RGB without alpha keeps the pixmaps small. The resulting png can also be
+    # copied as is into the output pdf (see PDF.loadRawPNG).
+    for page, imgFile in zip(doc, ("recto_.png", "verso_.png")):
+        pix = page.get_pixmap(dpi=300, colorspace=fitz.csRGB, alpha=False)
+        pix.save(imgFile)
+        pix = None
     return "recto_.png","verso_.png"
 
 def doit(args):
@@ -185,14 +315,14 @@ def doit(args):
 
     pdf = PDF(recto,verso,args.npp,margin=args.margin,xAdjust=args.x,yAdjust=args.y,fontSizeAdjust=args.f)
     pdf.setAddressList(csvFile,headerLines=args.skip,sortByZip=args.sort)
-    pdf.createPDF(outFile=args.outFile,numPages=args.np,testMode=args.test)
+    pdf.createPDF(outFile=args.outFile,numPages=args.np,testMode=args.test,numJobs=args.j)
 
 
 if __name__ == '__main__':
     import argparse
     desc = '''
 Creates a mailing PDF by merging a pair of recto/verso images with an address list
-See https://pyfpdf.readthedocs.io/en/latest/reference/image/index.html for supported image formats
+See https://py-pdf.github.io/fpdf2/Images.html for supported image formats
 The csv file is expected to have the following fields: "Name","Street","City","State","ZIP code" separated by commas
 and is expected to follow the "unix" convention, see "dialects" in the python csv module.
 If npp is 1, the page is in landscape format and there is page for the recto and one page for the verso.
@@ -202,6 +332,7 @@ The -f flag can be used to fine tune font size.
 The -test flag is useful for outputting the verso pages only with the longest addresses first
 The -i flag can be used to first extract the recto and verso pages from an existing PDF. In that case, you can ommit
 the recto and verso inputs.
+The -j flag can be used to render the pages with several processes, this requires pypdf ('pip install pypdf').
 Example:
 PDFMail.py -skip 1 -npp 2 -o mail.pdf Recto.png Verso.png addresses.csv
 To extract the recto/verso images from an existing pdf:
@@ -219,6 +350,7 @@ PDFMail.py -skip 1 -f -1 -npp 2 -o mail.pdf Recto.png Verso.png addresses.csv
     parser.add_argument('-x', type=float, default=0, help='Adjustment for horizontal position of address, in +/-inch (default 0)')
     parser.add_argument('-y', type=float, default=0, help='Adjustment for vertical position of address, in +/-inch (default 0)')
     parser.add_argument('-f', type=int, default=0, help='Adjustment for font size (default 0')
+    parser.add_argument('-j', type=int, default=1, help='Number of processes used to render the pages, 0 for all cores (default 1)')
     parser.add_argument('-o', dest='outFile', default="output.pdf", help='Name of output file (default output.pdf)')
     parser.add_argument('-i', dest='inPDFFile', help='Optional input pdf file which will be used to extract the recto and verso)')
     parser.add_argument('args', metavar='recto verso csvFile', nargs=argparse.REMAINDER, help='recto verso csvFile or csvFile if the -i option is used')